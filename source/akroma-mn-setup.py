@@ -2,11 +2,16 @@
 """Akroma MasterNode Setup and Auto-Update"""
 
 import argparse
-from jinja2 import Environment, FileSystemLoader
 import os
+import pipes
 import pwd
+import socket
 import sys
 import lib.api as api
+import lib.cache as cache
+import lib.rollout as rollout
+import lib.service as service_unit
+import lib.snapshot as snapshot
 import lib.utils as utils
 
 GETH_URI = 'https://github.com/akroma-project/akroma/releases/download'
@@ -15,6 +20,10 @@ SCRIPTS_URI = 'https://github.com/akroma-project/akroma-masternode-management/re
 SCRIPTS_VERSIONS_URI = 'https://raw.githubusercontent.com/akroma-project/akroma-masternode-management/master/versions.json'
 VERSION = '0.0.7'
 
+# Release mirrors, tried alongside the GitHub origin hosts above.  A mirror is a
+# base URL serving the same paths, ie https://mirror/akroma-project/akroma/...
+MIRRORS = []
+
 # OS and Version compatibility matrix (Major version)
 COMPAT_MATRIX = {'CentOS': [7],
                  'Debian': [9],
@@ -40,16 +49,65 @@ def main():
     parser.add_argument("--no-rpcuser", help="Remove RPC User/Password (Optional)", action='store_true')
     parser.add_argument("--no-rpcpassword", help="Remove RPC User/Password (Optional)", dest="no_rpcuser", \
                         action='store_true')
+    parser.add_argument("--instance", help="Manage akromanode@INSTANCE, for multiple masternodes per host (Optional)", \
+                        type=int, default=None)
+    parser.add_argument("--datadir", help="Geth data directory (Default: ~user/.akroma, ~user/.akroma-INSTANCE)", \
+                        type=str)
+    parser.add_argument("--cpus", help="CPUs to pin akromanode to, ie '0 1' or '0-3', or auto " \
+                        "(Default: auto for instances)", type=str)
+    parser.add_argument("--cpu-shares", help="Relative CPU weight of akromanode (Optional)", type=int)
     parser.add_argument("--ufw", help="Configure UFW (Optional)", action='store_true')
+    parser.add_argument("--mirror", help="Additional release mirror base URL (Optional, repeatable)", \
+                        action='append', default=[])
+    parser.add_argument("--cache", help="LAN release cache URL to download from, ie http://host:%d (Optional)" % \
+                        cache.CACHE_PORT, type=str)
+    parser.add_argument("--serve-cache", help="Run a LAN release cache server on PORT (Default: %d)" % \
+                        cache.CACHE_PORT, nargs='?', const=cache.CACHE_PORT, type=int, default=None, metavar='PORT')
+    parser.add_argument("--rollout", help="Update geth only when granted a slot by the rollout coordinator " \
+                        "at URL, or state FILE (Optional)", type=str, metavar='URL|FILE')
+    parser.add_argument("--serve-rollout", help="Run a rollout coordinator on PORT (Default: %d)" % \
+                        rollout.ROLLOUT_PORT, nargs='?', const=rollout.ROLLOUT_PORT, type=int, default=None, \
+                        metavar='PORT')
+    parser.add_argument("--canaries", help="Rollout canary nodes, with --serve-rollout or --rollout FILE " \
+                        "(Default: 1)", type=int, default=None)
+    parser.add_argument("--max-parallel", help="Rollout nodes updating at once, with --serve-rollout or " \
+                        "--rollout FILE (Default: 2)", type=int, default=None)
+    parser.add_argument("--export-snapshot", help="Export chaindata snapshot to FILE, or - for stdout", \
+                        type=str, metavar='FILE')
+    parser.add_argument("--import-snapshot", help="Import chaindata snapshot from FILE, URL, or - for stdin, " \
+                        "before akromanode first starts", type=str, metavar='SOURCE')
     parser.add_argument("--update-only", help="Update geth and scripts only.  Disables auto-update cron", action='store_true')
     parser.add_argument("-v", "--version", help="Script Version", action='store_true')
     args = parser.parse_args()
+    if args.instance is not None and args.instance < 1:
+        parser.error("--instance must be 1 or greater.")
+    if args.cpus is not None and not utils.isvalidcpus(args.cpus):
+        parser.error("--cpus must be auto or a list of CPUs, ie '0 1' or '0-3'.")
+    # Rollout settings only apply where a coordinator runs, not to a remote one
+    rollout_settings = dict((k, v) for k, v in (('canaries', args.canaries), ('concurrency', args.max_parallel)) \
+                            if v is not None)
+    if rollout_settings and args.serve_rollout is None and \
+       (not args.rollout or args.rollout.startswith(('http://', 'https://'))):
+        parser.error("--canaries and --max-parallel require --serve-rollout or --rollout FILE.")
+    service = utils.service_name(args.instance)
 
     # Display script version
     if args.version:
         print "Version: %s" % VERSION
         sys.exit(0)
 
+    # Serve release files to the LAN, instead of setting up akromanode
+    if args.serve_cache is not None:
+        utils.print_cmd('Serving release cache on port %d...' % args.serve_cache)
+        cache.serve(args.serve_cache, mirrors=api.Mirrors(MIRRORS + args.mirror))
+        sys.exit(0)
+
+    # Coordinate fleet geth updates, instead of setting up akromanode
+    if args.serve_rollout is not None:
+        utils.print_cmd('Serving rollout coordinator on port %d...' % args.serve_rollout)
+        rollout.serve(args.serve_rollout, **rollout_settings)
+        sys.exit(0)
+
     # Get the OS, OS family (ie, Debian or RedHat),  OS version, and machine architecture
     os_name, os_family, os_ver, os_arch = utils.os_detect()
     if os_name not in COMPAT_MATRIX or os_ver not in COMPAT_MATRIX[os_name]:
@@ -58,11 +116,11 @@ def main():
 
     # Migrate old masternode service to akromanode
     restart_service = False
-    if utils.service_status('masternode', 'is-active'):
+    if not args.instance and utils.service_status('masternode', 'is-active'):
         utils.print_cmd('Migrating masternode service...')
         if utils.service_status('masternode', 'stop'):
             os.rename('/etc/systemd/system/masternode.service', '/etc/systemd/system/akromanode.service')
-            ret, _ = utils.timed_run('/bin/systemctl daemon-reload')
+            ret, _ = utils.stream_run('/bin/systemctl daemon-reload')
             if ret is None or int(ret) != 0:
                 raise Exception('ERROR: Migration of masternode service failed')
             restart_service = True
@@ -78,16 +136,19 @@ def main():
         if res != 'Y':
             sys.exit(0)
         utils.print_cmd('Removing masternode installation...')
-        f = '/etc/systemd/system/akromanode.service'
+        f = utils.service_file_path(args.instance)
         if os.path.isfile(f):
             for status in ('stop', 'disable'):
-                if not utils.service_status('akromanode', status):
-                    raise Exception("ERROR: Failed to %s akromanode service" % status)
+                if not utils.service_status(service, status):
+                    raise Exception("ERROR: Failed to %s %s service" % (status, service))
             # If service file was a symlink, systemctl would have removed it
             # Check if the file still exists
             if os.path.isfile(f):
                 os.remove(f)
-        utils.autoupdate_cron(os_family, remove=True)
+        utils.autoupdate_cron(os_family, remove=True, instance=args.instance)
+        # Other instances still rely on geth and the scripts
+        if utils.instances():
+            sys.exit(0)
         # Remove scripts
         for f in ('geth-akroma', 'akroma-mn-setup', 'akroma-mn-utils'):
             f = '/usr/sbin/' + f
@@ -95,9 +156,31 @@ def main():
                 os.remove(f)
         sys.exit(0)
 
+    taken = utils.taken_ports(args.instance)
+    for option, port in (('--port', args.port), ('--rpcport', args.rpcport)):
+        if port is not None and port in taken:
+            parser.error("%s %d is already used by another akromanode unit." % (option, port))
+    service_file = utils.parse_service_file(args) # Parse akromanode(@N).service, if it exists, and override defaults
+    chaindata = '%s/geth/chaindata' % utils.datadir(args)
+    if args.import_snapshot and snapshot.has_chaindata(chaindata):
+        parser.error("--import-snapshot requires an empty chaindata, %s is not." % chaindata)
+
+    # Export chaindata snapshot, instead of setting up akromanode (offline, pigz only if already installed)
+    if args.export_snapshot:
+        if args.export_snapshot != '-':
+            utils.print_cmd('Exporting %s snapshot...' % chaindata)
+        snapshot.export_snapshot(chaindata, args.export_snapshot, service)
+        sys.exit(0)
+
     # Get current geth version, and those returned by API
-    geth_versions = api.get_script_versions(GETH_VERSIONS_URI, '/usr/sbin/geth-akroma version')
-    service_file = utils.parse_service_file(args) # Parse akromanode.service, if it exists, and override defaults
+    mirrors = api.Mirrors(MIRRORS + args.mirror, cache=args.cache)
+    geth_versions = api.get_script_versions(GETH_VERSIONS_URI, '/usr/sbin/geth-akroma version', mirrors)
+    if args.import_snapshot:
+        # Best effort, snapshots fall back to (single threaded) gzip
+        if os_family == 'RedHat':
+            utils.stream_run('/usr/bin/yum -d1 -y install pigz')
+        else:
+            utils.stream_run('/usr/bin/apt-get install pigz -y')
 
     # Gather data for interactive mode
     if args.interactive:
@@ -115,7 +198,7 @@ def main():
         while True:
             res = utils.input_text('Network listening port (Default: 30303):', args.port)
             res = 30303 if res.isspace() or res == '' else res
-            if isinstance(res, (int)) or res.isdigit():
+            if (isinstance(res, (int)) or res.isdigit()) and int(res) not in taken:
                 args.port = int(res)
                 break
             else:
@@ -124,7 +207,7 @@ def main():
         while True:
             res = utils.input_text('RPC Port (Default: 8545):', args.rpcport)
             res = 8545 if res.isspace() or res == '' else res
-            if isinstance(res, (int)) or res.isdigit():
+            if (isinstance(res, (int)) or res.isdigit()) and int(res) not in taken:
                 args.rpcport = int(res)
                 break
             else:
@@ -177,47 +260,42 @@ def main():
         except KeyError:
             print "Creating user %s." % args.user
             if os_family == 'RedHat':
-                ret, _ = utils.timed_run('/usr/sbin/adduser -r %s -s /bin/false -b /home -m' % args.user)
+                ret, _ = utils.stream_run('/usr/sbin/adduser -r %s -s /bin/false -b /home -m' % args.user)
             else:
-                ret, _ = utils.timed_run('/usr/sbin/adduser %s --gecos "" --disabled-password --system --group' % args.user)
+                ret, _ = utils.stream_run('/usr/sbin/adduser %s --gecos "" --disabled-password --system --group' % \
+                                          args.user)
             if ret is None or int(ret) != 0:
                 raise Exception("ERROR: Failed to create user %s" % args.user)
 
-    # Install OS Family specific dependencies
-    utils.print_cmd('Installing dependencies...')
-    if os_family == 'RedHat':
-        ret, _ = utils.timed_run('/usr/bin/yum -d1 -y install curl')
-    else:
-        ret, _ = utils.timed_run('/usr/bin/apt-get install curl -y')
-    if ret is None or int(ret) != 0:
-        raise Exception("ERROR: Failed to install curl")
-
     # Install and configure UFW, if True
     if args.interactive:
         res = utils.input_bool('Install and configure ufw [y|N]', 'N')
         args.ufw = True if res == 'Y' else False
     if args.ufw:
         if os_arch == 'x86_64' or os_family == 'Debian':
+            # Rules are reset, so allow the ports of every akromanode unit
+            ports = set([(args.port, args.rpcport)])
+            ports.update(utils.service_ports(i) for i in utils.instances() if i != args.instance)
             ufw_rules = ['/usr/sbin/ufw --force reset',
                          '/usr/sbin/ufw --force disable',
                          '/usr/sbin/ufw default deny incoming',
                          '/usr/sbin/ufw default allow outgoing',
-                         '/usr/sbin/ufw allow ssh',
-                         '/usr/sbin/ufw allow %s/tcp' % args.rpcport,
-                         '/usr/sbin/ufw allow %s/tcp' % args.port,
-                         '/usr/sbin/ufw allow %s/udp' % args.port,
-                         '/usr/sbin/ufw --force enable',
-                         '/usr/sbin/ufw status'
-                        ]
+                         '/usr/sbin/ufw allow ssh']
+            for port, rpcport in sorted(p for p in ports if p):
+                ufw_rules += ['/usr/sbin/ufw allow %s/tcp' % rpcport,
+                              '/usr/sbin/ufw allow %s/tcp' % port,
+                              '/usr/sbin/ufw allow %s/udp' % port]
+            ufw_rules += ['/usr/sbin/ufw --force enable',
+                          '/usr/sbin/ufw status']
             utils.print_cmd('Installing/configuring ufw...')
             if os_family == 'RedHat':
-                ret, _ = utils.timed_run('/usr/bin/yum -d1 -y install ufw')
+                ret, _ = utils.stream_run('/usr/bin/yum -d1 -y install ufw')
             else:
-                ret, _ = utils.timed_run('/usr/bin/apt-get install ufw -y')
+                ret, _ = utils.stream_run('/usr/bin/apt-get install ufw -y')
             if ret is None or int(ret) != 0:
                 raise Exception("ERROR: Failed to install ufw")
             for rule in ufw_rules:
-                ret, _ = utils.timed_run(rule)
+                ret, _ = utils.stream_run(rule)
                 if ret is None or int(ret) != 0:
                     raise Exception("ERROR: Failed to configure ufw")
             for status in ('enable', 'start'):
@@ -240,50 +318,89 @@ def main():
             else:
                 print "Geth version must be stable or latest"
 
+    # Wait for the rollout coordinator to hand out an update slot
+    rollout_client = None
+    if args.geth and args.rollout:
+        rollout_client = rollout.RolloutClient(args.rollout, **rollout_settings)
+        if not rollout.wait_for_slot(rollout_client, socket.getfqdn(), geth_versions[args.geth]):
+            print "Rollout of geth %s halted or postponed, skipping update" % geth_versions[args.geth]
+            args.geth = None
+            rollout_client = None
+
     # If geth version update required, download and install new version
+    # Every instance shares geth, note those running to restart them afterwards
+    active = [i for i in utils.instances() if utils.service_status(utils.service_name(i), 'is-active')]
     if args.geth:
         utils.print_cmd('Installing/upgrading geth %s...' % geth_versions[args.geth])
-        if not api.download_geth(os_arch, geth_versions[args.geth], GETH_URI):
+        if not api.download_geth(os_arch, geth_versions[args.geth], GETH_URI, mirrors):
             raise Exception('ERROR: Failed to download geth')
         restart_service = True
 
     # If auto-generated service file != on-disk service file, rewrite it
-    # Load and render template
     if not args.update_only:
-        jinja2_env = Environment(loader=FileSystemLoader(utils.resource_path('templates')))
-        template = jinja2_env.get_template('akromanode.service.tmpl')
-        new_service_file = template.render(args=args, os_family=os_family)
+        new_service_file = service_unit.render(args)
         if service_file != new_service_file:
-            utils.print_cmd('Creating/updating akromanode service file...')
-            f = '/etc/systemd/system/akromanode.service'
+            utils.print_cmd('Creating/updating %s service file...' % service)
+            f = utils.service_file_path(args.instance)
             with open(f, 'w') as fd:
                 fd.write(new_service_file)
                 utils.check_perms(f, '0644')
-            ret, _ = utils.timed_run('/bin/systemctl daemon-reload')
+            ret, _ = utils.stream_run('/bin/systemctl daemon-reload')
             if ret is None or int(ret) != 0:
                 raise Exception('ERROR: Failed to reload systemctl')
             restart_service = True
 
+    # Bootstrap chaindata from a snapshot
+    if args.import_snapshot:
+        utils.print_cmd('Importing chaindata snapshot...')
+        if utils.service_status(service, 'is-active'):
+            utils.service_status(service, 'stop')
+        print "sha256: %s" % snapshot.import_snapshot(args.import_snapshot, chaindata)
+        if args.user:
+            ret, _ = utils.stream_run('/bin/chown -R %s:%s %s' % (args.user, args.user, utils.datadir(args)))
+            if ret is None or int(ret) != 0:
+                raise Exception("ERROR: Failed to set ownership on %s" % utils.datadir(args))
+        restart_service = True
+
     # Enable and restart akromanode if service or geth updates have been made
-    if not utils.service_status('akromanode', 'is-active') or restart_service:
-        utils.print_cmd('Enabling and (re)starting akromanode service...')
+    if not utils.service_status(service, 'is-active') or restart_service:
+        utils.print_cmd('Enabling and (re)starting %s service...' % service)
         for status in ('enable', 'restart'):
-            utils.service_status('akromanode', status)
+            utils.service_status(service, status)
+    if args.geth:
+        for i in active:
+            if i != args.instance:
+                utils.print_cmd('Restarting %s service...' % utils.service_name(i))
+                utils.service_status(utils.service_name(i), 'restart')
+
+    # Report post-upgrade health, releasing the rollout slot
+    if rollout_client:
+        utils.print_cmd('Checking %s health...' % service)
+        healthy = utils.node_health(args)
+        action = rollout.report_health(rollout_client, socket.getfqdn(), geth_versions[args.geth], healthy)
+        print "Healthy: %s, rollout: %s" % (healthy, action)
 
     # Enable auto-update and update scripts
     if args.update_only:
-        utils.autoupdate_cron(os_family, remove=True)
+        utils.autoupdate_cron(os_family, remove=True, instance=args.instance)
     else:
-        utils.autoupdate_cron(os_family)
+        # Keep download sources for the auto-update run
+        cron_args = ['--instance %d' % args.instance] if args.instance else []
+        cron_args += ['--cache %s' % pipes.quote(args.cache)] if args.cache else []
+        cron_args += ['--rollout %s' % pipes.quote(args.rollout)] if args.rollout else []
+        cron_args += ['--canaries %d' % args.canaries] if args.rollout and args.canaries is not None else []
+        cron_args += ['--max-parallel %d' % args.max_parallel] if args.rollout and args.max_parallel is not None else []
+        cron_args += ['--mirror %s' % pipes.quote(m) for m in args.mirror]
+        utils.autoupdate_cron(os_family, args=' '.join(cron_args), instance=args.instance)
 
     # Get current setup version, and those returned by API
-    script_versions = api.get_script_versions(SCRIPTS_VERSIONS_URI, '/usr/sbin/akroma-mn-setup -v')
+    script_versions = api.get_script_versions(SCRIPTS_VERSIONS_URI, '/usr/sbin/akroma-mn-setup -v', mirrors)
 
     # Determine if setup/utils version needs to be updated
     if args.scripts is None or script_versions['current'] == script_versions[args.scripts]:
         args.scripts = utils.has_update(script_versions)
     if args.scripts:
-        api.autoupdate_scripts(os_arch, script_versions[args.scripts], SCRIPTS_URI)
+        api.autoupdate_scripts(os_arch, script_versions[args.scripts], SCRIPTS_URI, mirrors)
 
     utils.print_cmd('Akroma MasterNode up-to-date...')
 
@@ -6,7 +6,7 @@ block_cipher = None
 a = Analysis(['akroma-mn-setup.py'],
              pathex=['akroma-masternode-management/source'],
              binaries=[],
-             datas=[('templates', 'templates')],
+             datas=[],
              hiddenimports=[],
              hookspath=[],
              runtime_hooks=[],
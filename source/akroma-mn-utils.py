@@ -21,40 +21,61 @@ def main():
         print "Version: %s" % VERSION
         sys.exit(0)
 
-    utils.parse_service_file(args) # Parse akromanode.service
-    if args.user is None:
-        args.user = 'root'
+    # Parse akromanode.service and every akromanode@N.service
+    nodes = []
+    for instance in utils.instances() or [None]:
+        node = argparse.Namespace(instance=instance)
+        utils.parse_service_file(node)
+        if node.user is None:
+            node.user = 'root'
+        nodes.append(node)
 
-    # Get public ip
-    node_ip = utils.my_ip()
+    # Get public ip, geth versions, and the state of every instance in one pass
+    results = utils.concurrent([(utils.my_ip, ()),
+                                (get_script_versions, (GETH_VERSIONS_URI, '/usr/sbin/geth-akroma version'))] + \
+                               [(node_status, (node, )) for node in nodes])
+    node_ip, geth_versions, statuses = results[0], results[1], results[2:]
 
-    # Check if node port is accessible
-    node_port_accessible = utils.check_socket(node_ip, args.rpcport)
+    # Check if node RPC and P2P (TCP and UDP discovery) ports are accessible
+    node_ports = utils.check_ports(node_ip, [probe for node in nodes for probe in
+                                             (('tcp', node.rpcport), ('tcp', node.port), ('udp', node.port))])
 
-    # Determine if akromanode service is running
-    systemd_inuse = utils.service_status('akromanode', 'is-active')
-
-    # Get geth versions
-    geth_versions = get_script_versions(GETH_VERSIONS_URI, '/usr/sbin/geth-akroma version')
-
-    print "Enode Id: %s" % utils.get_enodeid(args)
     print "Node IP: %s" % node_ip
-    print "Node Port: %s" % args.rpcport
-    if args.rpcuser is not None and args.rpcpassword is not None:
-        print "RPC User: %s" % args.rpcuser
-        print "RPC Password: %s" % args.rpcpassword
     print "Geth Versions:"
     for k, v in sorted(geth_versions.items()):
         print "\t%s : %s" % (k, v)
-    print "Service Is-Active: %s" % systemd_inuse
-    print "Port is open locally: %s" % node_port_accessible
-    if systemd_inuse:
-        print "Service Error(s):"
-        ret, out = utils.timed_run('/bin/journalctl -u akromanode.service -n 20 -p 5')
-        if ret is None or int(ret) != 0:
-            print "ERROR: Failed to read akromanode journal data"
-        else:
-            print out
+    for node, status in zip(nodes, statuses):
+        print "Service: %s" % utils.service_name(node.instance)
+        print "Enode Id: %s" % status['enodeid']
+        print "Node Port: %s" % node.rpcport
+        if node.rpcuser is not None and node.rpcpassword is not None:
+            print "RPC User: %s" % node.rpcuser
+            print "RPC Password: %s" % node.rpcpassword
+        print "Service Is-Active: %s" % status['active']
+        print "Port(s) reachable via public IP:"
+        for proto, port in (('tcp', node.rpcport), ('tcp', node.port), ('udp', node.port)):
+            state, latency = node_ports[(proto, port)]
+            print "\t%s/%s : %s%s" % (port, proto, state, '' if latency is None else ' (%d ms)' % latency)
+        if status['active']:
+            print "Service Error(s):"
+            if status['journal'] is None:
+                print "ERROR: Failed to read %s journal data" % utils.service_name(node.instance)
+            else:
+                print status['journal']
+
+def node_status(args):
+    """
+    Get enode id, service state and recent errors of an akromanode instance
+    """
+    service = utils.service_name(args.instance)
+    status = {'active': utils.service_status(service, 'is-active'),
+              'enodeid': utils.get_enodeid(args),
+              'journal': None}
+    if status['active']:
+        ret, out = utils.timed_run('/bin/journalctl -u %s.service -n 20 -p 5' % service)
+        if ret is not None and int(ret) == 0:
+            status['journal'] = out
+    return status
 
 if __name__ == '__main__':
     main()
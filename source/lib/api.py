@@ -2,37 +2,45 @@
 Interface to interact with requests
 """
 
+import hashlib
+import json
 import os
+import Queue
 from StringIO import StringIO
+import threading
+import time
+import urlparse
 import zipfile
 import requests
 from retrying import retry
 import lib.utils as utils
 
-def autoupdate_scripts(arch, version, url):
+MIRROR_STATS_FILE = '/var/lib/akroma-mn/mirrors.json'
+# Ask for unencoded bodies, so Content-Length and Range offsets are raw bytes
+IDENTITY = {'Accept-Encoding': 'identity'}
+
+def autoupdate_scripts(arch, version, url, mirrors=None):
     """
     Auto-update scripts when new versions detected upstream
     """
+    mirrors = Mirrors() if mirrors is None else mirrors
     path = '/usr/sbin/'
     url += version + '/'
     for f in ('akroma-mn-setup', 'akroma-mn-utils'):
-        ret = HttpRetry().run('GET', url=url + f + '.' + arch)
-        if ret.status_code != 200:
+        content = mirrors.fetch(url + f + '.' + arch)
+        if content is None:
             print "ERROR: Failed to update %s" % f
         else:
             f = path + f
             # Need to remove binary before replacing it
             if os.path.isfile(f):
                 os.remove(f)
-            data = StringIO()
-            data.write(ret.content)
-            data.seek(0)
             with open(f, 'w') as fd:
                 utils.print_cmd('Updating %s...' % f)
-                fd.write(data.read())
+                fd.write(content)
                 utils.check_perms(f, '0700')
 
-def download_geth(arch, version, url):
+def download_geth(arch, version, url, mirrors=None):
     """
     Download and install geth
     """
@@ -56,24 +64,28 @@ def download_geth(arch, version, url):
         return False
     url += '.%s.zip' % version
 
-    if utils.service_status('akromanode', 'is-active'):
-        utils.service_status('akromanode', 'stop')
+    # Every akromanode instance runs the geth binary about to be replaced
+    for instance in utils.instances():
+        service = utils.service_name(instance)
+        if utils.service_status(service, 'is-active'):
+            utils.service_status(service, 'stop')
 
-    if extract_zip(url, '/usr/sbin'):
+    if extract_zip(url, '/usr/sbin', mirrors):
         f = '/usr/sbin/geth-akroma'
         utils.check_perms(f, '0755')
         return True
     return False
 
-def extract_zip(url, directory):
+def extract_zip(url, directory, mirrors=None):
     """
     Download zip file, in memory, and extract to disk
     """
+    mirrors = Mirrors() if mirrors is None else mirrors
     try:
-        ret = HttpRetry().run('GET', url=url)
-        if ret.status_code != 200:
+        content = mirrors.fetch(url)
+        if content is None:
             raise zipfile.BadZipfile
-        f = zipfile.ZipFile(StringIO(ret.content))
+        f = zipfile.ZipFile(StringIO(content))
         for fn in f.infolist():
             if fn.filename == 'geth':
                 fn.filename = 'geth-akroma'
@@ -82,19 +94,25 @@ def extract_zip(url, directory):
     except zipfile.BadZipfile:
         return False
 
-def get_script_versions(url, cmd):
+def get_script_versions(url, cmd, mirrors=None):
     """
     Query scripts versions.json
     """
-    headers = {'content-type': 'application/json'}
-    ret = HttpRetry().run('GET', \
-                  url=url, \
-                  headers=headers)
+    if mirrors and mirrors.configured():
+        content = mirrors.fetch(url, verify=False)
+        if content is None:
+            raise Exception('"%s" failed on all mirrors' % url)
+        data = json.loads(content)
+    else:
+        headers = {'content-type': 'application/json'}
+        ret = HttpRetry().run('GET', \
+                      url=url, \
+                      headers=headers)
 
-    if ret.status_code != 200:
-        raise Exception('"%s" returned error %d' % (url, ret.status_code))
+        if ret.status_code != 200:
+            raise Exception('"%s" returned error %d' % (url, ret.status_code))
 
-    data = ret.json()
+        data = ret.json()
     data.update({'current': utils.script_version(cmd)})
     return data
 
@@ -158,3 +176,223 @@ class HttpRetry(object):
             raise Exception("Invalid method: %s" % method)
         return do_retry(method, connect_retries, connect_wait_ms, \
                         url, params=params, headers=headers, timeout=timeout)
+
+class Mirrors(object):
+    """
+    Latency-ranked release mirrors with mid-transfer fail-over
+
+    A mirror is a base URL serving the same paths as the origin host (ie,
+    https://mirror/akroma-project/akroma/releases/download/...).  The origin
+    is always a candidate, and the only trusted source of checksums.
+    Content without such a checksum (ie, versions.json) is never taken from
+    a mirror.
+
+    A LAN release cache (see lib.cache) serves /<origin host>/<path>, is
+    trusted like the origin, and is always tried first without probing.
+    """
+    def __init__(self, mirrors=None, stats_file=MIRROR_STATS_FILE, cache=None):
+        self.mirrors = [m.rstrip('/') for m in mirrors or []]
+        self.cache = cache.rstrip('/') if cache else None
+        self.stats_file = stats_file
+        self.stats = {}
+        if self.mirrors and stats_file:
+            try:
+                with open(stats_file) as fd:
+                    self.stats = json.load(fd)
+            except (IOError, ValueError):
+                pass
+
+    def configured(self):
+        """
+        Determine if any mirror or cache is set, otherwise only the origin is used
+        """
+        return bool(self.mirrors or self.cache)
+
+    def candidates(self, url):
+        """
+        Return [(base, url)] for the origin followed by every mirror,
+        ordered by previously recorded performance
+        """
+        parsed = urlparse.urlsplit(url)
+        origin = '%s://%s' % (parsed.scheme, parsed.netloc)
+        path = url[len(origin):]
+        ret = [(origin, url)] + [(m, m + path) for m in self.mirrors if m != origin]
+        return sorted(ret, key=lambda x: self._score(x[0]))
+
+    def rank(self, url, timeout=5):
+        """
+        Measure time-to-first-byte of every candidate concurrently
+        Return candidates fastest first, unresponsive ones last
+        """
+        candidates = self.candidates(url)
+        if self.cache:
+            # Leave upstream alone, it is only a fall-back to the cache
+            return self.trusted(url)[:1] + candidates
+        if len(candidates) == 1:
+            return candidates
+        results = Queue.Queue()
+        def _probe(base, url):
+            start = time.time()
+            try:
+                ret = requests.get(url, stream=True, headers=IDENTITY, timeout=timeout)
+                ok = ret.status_code in (200, 206) and ret.raw.read(1) != ''
+                ret.close()
+            except requests.exceptions.RequestException:
+                ok = False
+            results.put((base, time.time() - start if ok else None))
+
+        for base, candidate in candidates:
+            thread = threading.Thread(target=_probe, args=(base, candidate))
+            thread.daemon = True
+            thread.start()
+
+        ttfb = {}
+        deadline = time.time() + timeout
+        for _ in candidates:
+            try:
+                base, elapsed = results.get(timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                break
+            if elapsed is not None:
+                ttfb[base] = elapsed
+                self._record(base, ttfb_ms=elapsed * 1000)
+        self.save()
+        return sorted(candidates, key=lambda x: (x[0] not in ttfb, ttfb.get(x[0])))
+
+    def trusted(self, url):
+        """
+        Return [(base, url)] for the sources trusted without a checksum, the
+        cache (if any) followed by the origin
+        """
+        parsed = urlparse.urlsplit(url)
+        ret = [('%s://%s' % (parsed.scheme, parsed.netloc), url)]
+        if self.cache:
+            ret.insert(0, (self.cache, '%s/%s%s' % (self.cache, parsed.netloc, parsed.path)))
+        return ret
+
+    def fetch(self, url, verify=True, timeout=30, passes=3):
+        """
+        Download url, in memory, from the fastest candidate, resuming on the
+        next one should a transfer fail midway
+        Return the content, None if every candidate failed
+
+        Args:
+            url     : (str) origin URL
+            verify  : (bool) check content against the origin's url.sha256,
+                      mirrors being skipped without one
+            timeout : (int) maximum time to wait on connect/read (in sec)
+            passes  : (int) maximum rounds over all candidates
+        """
+        if not self.configured():
+            # Origin only, as before mirrors existed
+            ret = HttpRetry().run('GET', url=url)
+            return ret.content if ret.status_code == 200 else None
+
+        trusted = set(base for base, _ in self.trusted(url))
+        checksum = self.trusted_checksum(url) if verify and self.mirrors else None
+        if checksum is None:
+            # Nothing to verify mirrors against, only trusted sources will do
+            if verify and self.mirrors:
+                print "ERROR: No trusted checksum for %s, skipping mirrors" % url
+            candidates = self.trusted(url)
+        else:
+            candidates = self.rank(url)
+        data = StringIO()
+        sources = set() # every candidate which wrote into data
+        rejected = set() # candidates which served content failing verification
+        for base, candidate in candidates * passes:
+            if base in rejected:
+                continue
+            offset = data.tell()
+            headers = dict(IDENTITY, Range='bytes=%d-' % offset) if offset else IDENTITY
+            start = time.time()
+            ret = None
+            try:
+                ret = requests.get(candidate, stream=True, headers=headers, timeout=timeout)
+                if ret.status_code == 206 and \
+                   ret.headers.get('Content-Range', '').startswith('bytes %d-' % offset):
+                    pass
+                elif ret.status_code == 200:
+                    data.seek(0)
+                    data.truncate()
+                    sources = set()
+                else:
+                    raise requests.exceptions.HTTPError(ret.status_code)
+                for chunk in ret.iter_content(chunk_size=65536):
+                    sources.add(base)
+                    data.write(chunk)
+                # Content-Length counts bytes on the wire, before any decoding
+                received = ret.raw.tell()
+                expected = ret.headers.get('Content-Length')
+                if expected is not None and int(expected) != received:
+                    raise requests.exceptions.ChunkedEncodingError('Short read')
+            except (requests.exceptions.RequestException, ValueError):
+                self._record(base, failed=True)
+                if ret is not None and ret.headers.get('Content-Encoding', 'identity') != 'identity':
+                    # Decoded data cannot be resumed with a byte Range
+                    data = StringIO()
+                    sources = set()
+                continue
+            elapsed = max(time.time() - start, 0.001)
+            self._record(base, bps=received / elapsed)
+            content = data.getvalue()
+            if checksum is None or hashlib.sha256(content).hexdigest() == checksum:
+                self.save()
+                return content
+            else:
+                print "ERROR: Checksum mismatch for %s from %s" % (url, ', '.join(sorted(sources)))
+                for source in sources:
+                    self._record(source, failed=True)
+                # Any of them may be at fault, unless the origin served it all
+                rejected.update(sources - trusted or sources)
+            data = StringIO()
+            sources = set()
+        self.save()
+        return None
+
+    @staticmethod
+    def trusted_checksum(url):
+        """
+        Fetch the sha256 published beside url, from the origin only
+        """
+        try:
+            ret = HttpRetry().run('GET', url=url + '.sha256', connect_retries=3)
+            if ret.status_code == 200 and ret.text.split():
+                return ret.text.split()[0].lower()
+        except requests.exceptions.RequestException:
+            pass
+        return None
+
+    def save(self):
+        """
+        Persist per-mirror statistics for future runs
+        """
+        if not self.mirrors or not self.stats_file:
+            return
+        try:
+            directory = os.path.dirname(self.stats_file)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0o755)
+            with open(self.stats_file, 'w') as fd:
+                json.dump(self.stats, fd)
+        except (IOError, OSError):
+            pass
+
+    def _record(self, base, ttfb_ms=None, bps=None, failed=False, weight=0.3):
+        """
+        Fold a measurement into the exponentially weighted stats of base
+        """
+        stats = self.stats.setdefault(base, {'ttfb_ms': None, 'bps': None, 'failures': 0})
+        for key, value in (('ttfb_ms', ttfb_ms), ('bps', bps)):
+            if value is not None:
+                old = stats.get(key)
+                stats[key] = value if old is None else old + weight * (value - old)
+        stats['failures'] = stats.get('failures', 0) + 1 if failed else 0
+
+    def _score(self, base):
+        """
+        Sort key: fewest consecutive failures, then lowest time-to-first-byte
+        """
+        stats = self.stats.get(base, {})
+        ttfb = stats.get('ttfb_ms')
+        return stats.get('failures', 0), ttfb is None, ttfb
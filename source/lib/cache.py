@@ -0,0 +1,166 @@
+"""
+LAN release cache server, so a fleet downloads each release once
+"""
+
+import BaseHTTPServer
+import hashlib
+import logging
+import os
+import re
+import shutil
+import SocketServer
+import threading
+import time
+import requests
+import lib.api as api
+
+CACHE_DIR = '/var/cache/akroma-mn'
+CACHE_PORT = 8080
+# Upstream hosts the cache is allowed to fetch from (it is not an open proxy)
+UPSTREAM_HOSTS = ('github.com', 'raw.githubusercontent.com')
+
+class ReleaseCache(object):
+    """
+    On-disk cache of upstream release files
+
+    Release assets (under /releases/download/) never change and are kept
+    forever, anything else (ie, versions.json) is refreshed after ttl seconds.
+    Concurrent misses on the same file share a single upstream fetch.
+    """
+    def __init__(self, directory=CACHE_DIR, ttl=300, mirrors=None, hosts=UPSTREAM_HOSTS, scheme='https'):
+        self.directory = directory
+        self.ttl = ttl
+        self.mirrors = api.Mirrors() if mirrors is None else mirrors
+        self.hosts = hosts
+        self.scheme = scheme
+        self.lock = threading.Lock()
+        self.inflight = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+
+    def upstream(self, path):
+        """
+        Map a request path (/<host>/<path>) to its upstream URL
+        Return None if the host is not allowed or the path is invalid
+        """
+        parts = path.split('?', 1)[0].lstrip('/').split('/', 1)
+        if len(parts) != 2 or parts[0] not in self.hosts or \
+           not parts[1] or '..' in parts[1].split('/'):
+            return None
+        return '%s://%s/%s' % (self.scheme, parts[0], parts[1])
+
+    def get(self, url):
+        """
+        Return the path of the cached copy of url, fetching it on a miss
+        A stale copy is returned if upstream fails, None if there is none
+        """
+        fn = os.path.join(self.directory, hashlib.sha256(url).hexdigest())
+        if self._fresh(url, fn):
+            return fn
+        with self.lock:
+            job = self.inflight.get(url)
+            leader = job is None
+            if leader:
+                job = self.inflight[url] = {'event': threading.Event(), 'result': None}
+        if not leader:
+            job['event'].wait()
+            return job['result']
+
+        result = None
+        try:
+            logging.info(">> cache miss '%s'" % url)
+            try:
+                content = self.mirrors.fetch(url, verify=self._immutable(url))
+            except requests.exceptions.RequestException as e:
+                logging.info(">> upstream failed '%s': %s" % (url, e))
+                content = None
+            if content is not None:
+                tmp = '%s.%d' % (fn, threading.current_thread().ident)
+                with open(tmp, 'wb') as fd:
+                    fd.write(content)
+                os.rename(tmp, fn)
+                result = fn
+            elif os.path.isfile(fn):
+                result = fn
+        finally:
+            with self.lock:
+                del self.inflight[url]
+            job['result'] = result
+            job['event'].set()
+        return result
+
+    @staticmethod
+    def _immutable(url):
+        """
+        Release assets are immutable once published
+        """
+        return '/releases/download/' in url
+
+    def _fresh(self, url, fn):
+        """
+        Determine if the cached copy of url can be served as is
+        """
+        try:
+            age = time.time() - os.stat(fn).st_mtime
+        except OSError:
+            return False
+        return self._immutable(url) or 0 <= age < self.ttl
+
+class CacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve cached files, supporting 'Range: bytes=N-' to resume transfers
+    """
+    def do_GET(self):
+        """
+        Handle GET requests
+        """
+        url = self.server.cache.upstream(self.path)
+        if url is None:
+            self.send_error(404)
+            return
+        fn = self.server.cache.get(url)
+        if fn is None:
+            self.send_error(502)
+            return
+        with open(fn, 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            m = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+            offset = int(m.group(1)) if m else 0
+            if offset >= size > 0:
+                self.send_error(416)
+                return
+            if offset:
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (offset, size - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size - offset))
+            self.end_headers()
+            fd.seek(offset)
+            shutil.copyfileobj(fd, self.wfile, 65536)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        logging.info("%s - %s" % (self.address_string(), format % args))
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server bound to a ReleaseCache
+    """
+    daemon_threads = True
+
+    def __init__(self, address, cache):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheHandler)
+        self.cache = cache
+
+def serve(port=CACHE_PORT, address='', **kwargs):
+    """
+    Run the release cache server until interrupted
+    """
+    server = CacheServer((address, port), ReleaseCache(**kwargs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,313 @@
+"""
+Fleet-wide geth update rollout, in waves starting with canaries
+"""
+
+import BaseHTTPServer
+import fcntl
+import json
+import logging
+import os
+import random
+import SocketServer
+import time
+import requests
+
+ROLLOUT_PORT = 8081
+ROLLOUT_STATE = '/var/lib/akroma-mn/rollout.json'
+
+class Coordinator(object):
+    """
+    Hand out update slots to nodes, persisting state to a (lockable) file
+
+    Every version has its own rollout, so nodes following different channels
+    (stable/latest) do not interfere.  The first canaries nodes asking for a
+    version form wave 0, each later
+    wave being twice the size of the previous one.  A node may only upgrade
+    once every node of the earlier waves reported back, and no more than
+    concurrency nodes upgrade at once.  The rollout halts as soon as a
+    canary, or more than max_failures later nodes, report unhealthy.  A node
+    holding a slot for longer than lease seconds is deemed failed, and one
+    pending in an earlier wave for longer than lease no longer holds back
+    later waves.
+    """
+    def __init__(self, state_file=ROLLOUT_STATE, canaries=1, concurrency=2, \
+                 max_failures=0, lease=3600, retry=300):
+        self.state_file = state_file
+        self.canaries = canaries
+        self.concurrency = concurrency
+        self.max_failures = max_failures
+        self.lease = lease
+        self.retry = retry
+        directory = os.path.dirname(state_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+
+    def acquire(self, node, version):
+        """
+        Ask for a slot to upgrade node to version
+        Return {'action': 'go'|'wait'|'halt', 'retry': seconds}
+        """
+        with self._state() as state:
+            state = state['rollouts'].setdefault(version, {'version': version, 'halted': None, 'nodes': {}})
+            now = time.time()
+            self._expire(state, now)
+            nodes = state['nodes']
+            if node not in nodes:
+                nodes[node] = {'wave': self._wave(len(nodes)), 'state': 'pending', 'since': now}
+            info = nodes[node]
+            if state['halted'] or info['state'] == 'failed':
+                return {'action': 'halt', 'retry': self.retry}
+            if info['state'] in ('upgrading', 'healthy'):
+                return {'action': 'go', 'retry': 0}
+
+            blocking = [n for n in nodes.values() if n['wave'] < info['wave'] and \
+                        (n['state'] == 'upgrading' or \
+                         (n['state'] == 'pending' and now - n['since'] <= self.lease))]
+            upgrading = sum(1 for n in nodes.values() if n['state'] == 'upgrading')
+            if blocking or upgrading >= self.concurrency:
+                # Spread retries, so waiting nodes do not return all at once
+                return {'action': 'wait', 'retry': int(self.retry * random.uniform(0.5, 1.5))}
+            info.update({'state': 'upgrading', 'since': now})
+            return {'action': 'go', 'retry': 0}
+
+    def report(self, node, version, healthy):
+        """
+        Report post-upgrade health of node, releasing its slot
+        Reports for unknown versions or nodes are ignored
+        Return {'action': 'done'|'halt'}
+        """
+        with self._state() as state:
+            state = state['rollouts'].get(version)
+            if state is None:
+                return {'action': 'done'}
+            info = state['nodes'].get(node)
+            if info is None:
+                return {'action': 'halt' if state['halted'] else 'done'}
+            info.update({'state': 'healthy' if healthy else 'failed', 'since': time.time()})
+            self._check(state)
+            return {'action': 'halt' if state['halted'] else 'done'}
+
+    def resume(self, version=None):
+        """
+        Resume a halted rollout (every rollout if version is None), giving
+        failed nodes another chance
+        """
+        with self._state() as state:
+            for rollout_version, rollout in state['rollouts'].items():
+                if version is not None and rollout_version != version:
+                    continue
+                rollout['halted'] = None
+                for info in rollout['nodes'].values():
+                    if info['state'] == 'failed':
+                        info.update({'state': 'pending', 'since': time.time()})
+            return {'action': 'done'}
+
+    def status(self):
+        """
+        Get rollout state
+        """
+        with self._state() as state:
+            return dict(state)
+
+    def _check(self, state):
+        """
+        Halt the rollout if canaries regressed or the failure budget is spent
+        """
+        failed = [n for n in state['nodes'].values() if n['state'] == 'failed']
+        if any(n['wave'] == 0 for n in failed):
+            state['halted'] = 'Canary reported unhealthy'
+        elif len(failed) > self.max_failures:
+            state['halted'] = '%d node(s) reported unhealthy' % len(failed)
+        if state['halted']:
+            logging.info(">> rollout of %s halted: %s" % (state['version'], state['halted']))
+
+    def _expire(self, state, now):
+        """
+        Fail nodes which never reported back within their lease
+        """
+        for info in state['nodes'].values():
+            if info['state'] == 'upgrading' and now - info['since'] > self.lease:
+                info.update({'state': 'failed', 'since': now})
+        self._check(state)
+
+    def _state(self):
+        """
+        Lock, load and (on exit) save the state of every rollout
+        """
+        return _LockedState(self.state_file)
+
+    def _wave(self, index):
+        """
+        Get the wave of the index-th node (0-based) to join the rollout
+        """
+        wave, size, start = 0, self.canaries, 0
+        while index >= start + size:
+            start += size
+            size *= 2
+            wave += 1
+        return wave
+
+class _LockedState(object):
+    """
+    Context manager holding an exclusive lock on the state file
+    """
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.fd = None
+        self.state = None
+
+    def __enter__(self):
+        self.fd = open(self.state_file, 'a+')
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.fd.seek(0)
+        try:
+            self.state = json.loads(self.fd.read())
+        except ValueError:
+            self.state = {}
+        self.state.setdefault('rollouts', {})
+        return self.state
+
+    def __exit__(self, *exc):
+        try:
+            if exc[0] is None:
+                self.fd.seek(0)
+                self.fd.truncate()
+                self.fd.write(json.dumps(self.state))
+                self.fd.flush()
+                os.fsync(self.fd.fileno())
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.fd.close()
+
+class RolloutClient(object):
+    """
+    Talk to a coordinator, over HTTP (http://host:port) or through its
+    state file (ie, on shared storage), kwargs being the Coordinator
+    settings of the latter
+    """
+    def __init__(self, location, timeout=30, **kwargs):
+        self.location = location.rstrip('/')
+        self.timeout = timeout
+        self.local = None
+        if not location.startswith(('http://', 'https://')):
+            self.local = Coordinator(location, **kwargs)
+
+    def acquire(self, node, version):
+        """
+        Ask for an update slot
+        """
+        return self._call('acquire', node=node, version=version)
+
+    def report(self, node, version, healthy):
+        """
+        Report post-upgrade health
+        """
+        return self._call('report', node=node, version=version, healthy=healthy)
+
+    def _call(self, action, **kwargs):
+        if self.local:
+            return getattr(self.local, action)(**kwargs)
+        ret = requests.post('%s/%s' % (self.location, action), json=kwargs, timeout=self.timeout)
+        if ret.status_code != 200:
+            raise Exception('"%s/%s" returned error %d' % (self.location, action, ret.status_code))
+        return ret.json()
+
+class RolloutHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    JSON API: POST /acquire, /report, /resume and GET /status
+    """
+    def do_GET(self):
+        """
+        Handle GET requests
+        """
+        if self.path != '/status':
+            self.send_error(404)
+            return
+        self._reply(self.server.coordinator.status())
+
+    def do_POST(self):
+        """
+        Handle POST requests
+        """
+        coordinator = self.server.coordinator
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or '{}')
+            if self.path == '/acquire':
+                ret = coordinator.acquire(str(data['node']), str(data['version']))
+            elif self.path == '/report':
+                ret = coordinator.report(str(data['node']), str(data['version']), bool(data['healthy']))
+            elif self.path == '/resume':
+                ret = coordinator.resume(data.get('version'))
+            else:
+                self.send_error(404)
+                return
+        except (KeyError, TypeError, ValueError):
+            self.send_error(400)
+            return
+        self._reply(ret)
+
+    def _reply(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        logging.info("%s - %s" % (self.address_string(), format % args))
+
+class RolloutServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server bound to a Coordinator
+    """
+    daemon_threads = True
+
+    def __init__(self, address, coordinator):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RolloutHandler)
+        self.coordinator = coordinator
+
+def serve(port=ROLLOUT_PORT, address='', **kwargs):
+    """
+    Run the rollout coordinator until interrupted
+    """
+    server = RolloutServer((address, port), Coordinator(**kwargs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def report_health(client, node, version, healthy):
+    """
+    Report post-upgrade health, an unreachable coordinator being logged only
+    Return the coordinator action, None if it could not be reached
+    """
+    try:
+        return client.report(node, version, healthy)['action']
+    except Exception as e: # pylint: disable=broad-except
+        logging.error("Rollout coordinator report failed: %s" % e)
+        print "ERROR: Failed to report to rollout coordinator: %s" % e
+        return None
+
+def wait_for_slot(client, node, version, max_wait=6 * 3600):
+    """
+    Block until the coordinator lets node upgrade to version
+    Return True to go ahead, False if halted, max_wait exceeded, or the
+    coordinator could not be reached (postponing the update)
+    """
+    deadline = time.time() + max_wait
+    while True:
+        try:
+            ret = client.acquire(node, version)
+        except Exception as e: # pylint: disable=broad-except
+            logging.error("Rollout coordinator unavailable: %s" % e)
+            print "ERROR: Rollout coordinator unavailable, postponing update: %s" % e
+            return False
+        if ret['action'] == 'go':
+            return True
+        if ret['action'] == 'halt' or time.time() + ret['retry'] > deadline:
+            return False
+        print "Waiting %d sec for an update slot..." % ret['retry']
+        time.sleep(ret['retry'])
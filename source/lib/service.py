@@ -0,0 +1,152 @@
+"""
+akromanode systemd unit file model, shared by setup and utils
+"""
+
+import os
+import re
+import timeit
+
+# ExecStart options mapped to their ServiceConfig field and type
+EXEC_OPTIONS = {
+    '--datadir': ('datadir', str),
+    '--port': ('port', int),
+    '--rpcport': ('rpcport', int),
+    '--rpcuser': ('rpcuser', str),
+    '--rpcpassword': ('rpcpassword', str),
+}
+INSTANCE_RE = re.compile(r'\(instance (\d+)\)')
+
+_CACHE = {}
+
+class ServiceConfig(object):
+    """
+    Typed akromanode unit configuration, fields not set in the unit being None
+    """
+    def __init__(self, instance=None, user=None, cpus=None, cpu_shares=None, datadir=None, \
+                 port=None, rpcport=None, rpcuser=None, rpcpassword=None):
+        self.instance = instance
+        self.user = user
+        self.cpus = cpus
+        self.cpu_shares = cpu_shares
+        self.datadir = datadir
+        self.port = port
+        self.rpcport = rpcport
+        self.rpcuser = rpcuser
+        self.rpcpassword = rpcpassword
+
+    @classmethod
+    def parse(cls, content):
+        """
+        Parse unit file content in a single pass
+        """
+        config = cls()
+        for line in content.splitlines():
+            key, _, value = line.partition('=')
+            if key == 'ExecStart':
+                argv = value.split()
+                for option, arg in zip(argv, argv[1:]):
+                    if option in EXEC_OPTIONS:
+                        field, kind = EXEC_OPTIONS[option]
+                        try:
+                            setattr(config, field, kind(arg))
+                        except ValueError:
+                            pass
+            elif key == 'User':
+                config.user = value
+            elif key == 'CPUAffinity':
+                config.cpus = value
+            elif key == 'CPUShares' and value.isdigit():
+                config.cpu_shares = int(value)
+            elif key == 'Description':
+                m = INSTANCE_RE.search(value)
+                if m:
+                    config.instance = int(m.group(1))
+        return config
+
+    def render(self):
+        """
+        Render unit file content
+        """
+        return render(self)
+
+def load(service_file):
+    """
+    Read and parse service_file, cached until its mtime/size change
+    Return (content, ServiceConfig), (None, None) if it does not exist
+    """
+    try:
+        stat = os.stat(service_file)
+    except OSError:
+        _CACHE.pop(service_file, None)
+        return None, None
+    key = (stat.st_mtime, stat.st_size)
+    cached = _CACHE.get(service_file)
+    if cached and cached[0] == key:
+        return cached[1], cached[2]
+    try:
+        with open(service_file) as fd:
+            content = fd.read()
+    except IOError:
+        return None, None
+    config = ServiceConfig.parse(content)
+    _CACHE[service_file] = (key, content, config)
+    return content, config
+
+def render(args):
+    """
+    Render akromanode unit file content from args (or a ServiceConfig)
+    """
+    lines = ['[Unit]',
+             'Description=Akroma Client -- masternode service%s' % \
+             (' (instance %d)' % args.instance if args.instance else ''),
+             'After=network.target',
+             '',
+             '[Service]']
+    if args.user:
+        lines += ['User=%s' % args.user, 'Group=%s' % args.user]
+    lines += ['Type=simple', 'Restart=always', 'RestartSec=30s']
+    if args.cpus:
+        lines.append('CPUAffinity=%s' % args.cpus)
+    if args.cpu_shares:
+        lines.append('CPUShares=%s' % args.cpu_shares)
+    cmd = ['/usr/sbin/geth-akroma', '--masternode']
+    if args.datadir:
+        cmd += ['--datadir', str(args.datadir)]
+    # Instances always carry their port, the default being allocated to them
+    if args.port != 30303 or args.instance:
+        cmd += ['--port', str(args.port)]
+    cmd += ['--rpcport', str(args.rpcport), '--rpcvhosts', '*']
+    if args.rpcuser:
+        cmd += ['--rpcuser', str(args.rpcuser), '--rpcpassword', str(args.rpcpassword)]
+    lines += ['ExecStart=%s' % ' '.join(cmd),
+              '',
+              '[Install]',
+              'WantedBy=default.target',
+              '']
+    return '\n'.join(lines)
+
+def benchmark(number=10000):
+    """
+    Measure the cost of parsing (cold and cached) and rendering a unit file
+    Return per-operation times (in usec)
+    """
+    config = ServiceConfig(instance=2, user='akroma2', cpus='2 3', datadir='/home/akroma2/.akroma-2',
+                           port=30305, rpcport=8547, rpcuser='user', rpcpassword='password')
+    content = config.render()
+    path = '/tmp/akromanode-benchmark-%d.service' % os.getpid()
+    with open(path, 'w') as fd:
+        fd.write(content)
+    try:
+        times = {
+            'parse': timeit.timeit(lambda: ServiceConfig.parse(content), number=number),
+            'load (cached)': timeit.timeit(lambda: load(path), number=number),
+            'render': timeit.timeit(config.render, number=number),
+        }
+    finally:
+        os.remove(path)
+        _CACHE.pop(path, None)
+    return dict((k, v * 1e6 / number) for k, v in times.items())
+
+if __name__ == '__main__':
+    for name, usec in sorted(benchmark().items()):
+        print "%-14s: %.2f usec" % (name, usec)
@@ -0,0 +1,206 @@
+"""
+Chaindata snapshot export/import, to bootstrap masternodes without a full sync
+"""
+
+from distutils.spawn import find_executable
+import errno
+import hashlib
+import multiprocessing
+import os
+import shutil
+import sys
+import requests
+from subprocess32 import PIPE, Popen
+import lib.utils as utils
+
+CHUNK_SIZE = 1024 * 1024
+
+def compressor(decompress=False):
+    """
+    Get the compression command, parallel pigz if available, gzip otherwise
+    """
+    if find_executable('pigz'):
+        cmd = ['pigz', '-p', str(multiprocessing.cpu_count())]
+    else:
+        cmd = ['gzip']
+    return cmd + (['-d', '-c'] if decompress else ['-c'])
+
+def copy_stream(src, dst):
+    """
+    Copy chunks from iterable src to dst file object
+    Return sha256 hex digest of the data copied
+    """
+    digest = hashlib.sha256()
+    for chunk in src:
+        digest.update(chunk)
+        dst.write(chunk)
+    return digest.hexdigest()
+
+def export_snapshot(chaindata, output, service=None):
+    """
+    Export chaindata as a gzip'ed tar to output ('-' for stdout), and write
+    its sha256 manifest to output.sha256
+
+    The service is only stopped while LevelDB tables (*.ldb, never modified
+    once written) are hard-linked, and the remaining files copied, to a
+    staging directory.  Archiving happens from there once it is restarted.
+    """
+    if not os.path.isdir(chaindata):
+        raise Exception("ERROR: %s not found" % chaindata)
+    staging = chaindata.rstrip('/') + '.snapshot'
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+
+    restart = bool(service) and utils.service_status(service, 'is-active')
+    if restart and not utils.service_status(service, 'stop'):
+        raise Exception("ERROR: Failed to stop %s service" % service)
+    try:
+        stage(chaindata, staging)
+    finally:
+        if restart:
+            utils.service_status(service, 'start')
+
+    part = output + '.part'
+    procs = []
+    try:
+        tar = Popen(['tar', '-C', staging, '-cf', '-', '.'], stdout=PIPE)
+        procs.append(tar)
+        gz = Popen(compressor(), stdin=tar.stdout, stdout=PIPE)
+        procs.append(gz)
+        tar.stdout.close()
+        if output == '-':
+            digest = copy_stream(iter(lambda: gz.stdout.read(CHUNK_SIZE), ''), sys.stdout)
+        else:
+            with open(part, 'wb') as fd:
+                digest = copy_stream(iter(lambda: gz.stdout.read(CHUNK_SIZE), ''), fd)
+        if tar.wait() != 0 or gz.wait() != 0:
+            raise Exception("ERROR: Failed to archive %s" % chaindata)
+        if output != '-':
+            os.rename(part, output)
+    finally:
+        _reap(procs)
+        shutil.rmtree(staging)
+        if output != '-' and os.path.isfile(part):
+            os.remove(part)
+
+    if output == '-':
+        sys.stderr.write("%s  -\n" % digest)
+    else:
+        with open(output + '.sha256', 'w') as fd:
+            fd.write("%s  %s\n" % (digest, os.path.basename(output)))
+    return digest
+
+def has_chaindata(chaindata):
+    """
+    Determine if chaindata exists and is not empty (a snapshot cannot be
+    imported over it)
+    """
+    return os.path.isdir(chaindata) and bool(os.listdir(chaindata))
+
+def import_snapshot(source, chaindata, checksum=None):
+    """
+    Import a snapshot from source (a file, '-' for stdin, or an http(s) URL)
+    into an empty or missing chaindata, streaming it straight to disk
+
+    The sha256 is checked against checksum, or source.sha256 if it exists.
+    Data is extracted to a staging directory, and only moved in place once
+    verified.
+    """
+    if has_chaindata(chaindata):
+        raise Exception("ERROR: %s already contains chaindata" % chaindata)
+    if checksum is None:
+        checksum = manifest(source)
+
+    if source.startswith(('http://', 'https://')):
+        ret = requests.get(source, stream=True, timeout=30)
+        if ret.status_code != 200:
+            raise Exception('"%s" returned error %d' % (source, ret.status_code))
+        chunks = ret.iter_content(chunk_size=CHUNK_SIZE)
+    else:
+        fd = sys.stdin if source == '-' else open(source, 'rb')
+        chunks = iter(lambda: fd.read(CHUNK_SIZE), '')
+
+    staging = chaindata.rstrip('/') + '.import'
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    procs = []
+    try:
+        gz = Popen(compressor(decompress=True), stdin=PIPE, stdout=PIPE)
+        procs.append(gz)
+        tar = Popen(['tar', '-C', staging, '-xf', '-'], stdin=gz.stdout)
+        procs.append(tar)
+        gz.stdout.close()
+        try:
+            digest = copy_stream(chunks, gz.stdin)
+        except IOError as e:
+            # Broken pipe, decompression/extraction failed, reported below
+            if e.errno != errno.EPIPE:
+                raise
+            digest = None
+        finally:
+            gz.stdin.close()
+        if gz.wait() != 0 or tar.wait() != 0 or digest is None:
+            raise Exception("ERROR: Failed to extract snapshot %s" % source)
+        if checksum and digest != checksum:
+            raise Exception("ERROR: Snapshot checksum mismatch, expected %s got %s" % (checksum, digest))
+        if os.path.isdir(chaindata):
+            os.rmdir(chaindata)
+        elif not os.path.isdir(os.path.dirname(chaindata.rstrip('/'))):
+            os.makedirs(os.path.dirname(chaindata.rstrip('/')))
+        os.rename(staging, chaindata)
+    finally:
+        _reap(procs)
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+    return digest
+
+def manifest(source):
+    """
+    Read the sha256 published beside source, None if there is none
+    """
+    if source == '-':
+        return None
+    try:
+        if source.startswith(('http://', 'https://')):
+            ret = requests.get(source + '.sha256', timeout=30)
+            content = ret.text if ret.status_code == 200 else ''
+        else:
+            with open(source + '.sha256') as fd:
+                content = fd.read()
+    except (IOError, requests.exceptions.RequestException):
+        return None
+    return content.split()[0].lower() if content.split() else None
+
+def _reap(procs):
+    """
+    Kill any of procs still running and wait on all of them, so none is
+    left writing to a staging directory about to be removed
+    """
+    for proc in procs:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        if proc.stdout:
+            proc.stdout.close()
+
+def stage(src, dst):
+    """
+    Recreate src in dst, hard-linking immutable LevelDB tables and copying
+    everything else (logs, MANIFEST and ancient data are modified in place)
+    """
+    os.makedirs(dst)
+    for name in os.listdir(src):
+        s = os.path.join(src, name)
+        d = os.path.join(dst, name)
+        if os.path.isdir(s):
+            stage(s, d)
+            continue
+        if name.endswith('.ldb'):
+            try:
+                os.link(s, d)
+                continue
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM):
+                    raise
+        shutil.copy2(s, d)
@@ -3,43 +3,83 @@ Generic shared utilities
 """
 
 from itertools import ifilter
+import collections
+import errno
+import glob
+import json
 import logging
+import multiprocessing
 import os
+import pwd
+import Queue
 import random
 import re
 import readline
+import select
 import shlex
 import socket
 import sys
 import termios
+import threading
+import time
 import tty
+import requests
 from retrying import retry
-from subprocess32 import STDOUT, PIPE, Popen
+from subprocess32 import STDOUT, PIPE, CalledProcessError, Popen, TimeoutExpired
 from crontab import CronTab
 import distro
+import lib.service as service_unit
 
+# IPv4-only endpoints raced by my_ip, each returning the caller's address as text
+IP_ENDPOINTS = ['https://ipv4.icanhazip.com',
+                'https://api.ipify.org',
+                'https://v4.ident.me',
+                'https://checkip.amazonaws.com',
+               ]
+SERVICE_DIR = '/etc/systemd/system'
+# Lines of command output kept for logs and error reports
+OUTPUT_TAIL = 20
+IP_CACHE_FILE = '/var/lib/akroma-mn/ip.json'
+_IP_CACHE = {}
 
-def autoupdate_cron(os_family, remove=False):
+def autoupdate_cron(os_family, remove=False, args='', instance=None):
     """
-    Enable/remove Akroma Auto-update cron
+    Enable/remove Akroma Auto-update cron of akromanode instance (None being
+    the single akromanode), each unit having its own job told apart by its
+    --instance option
+    Existing jobs are rewritten to the current command, args being
+    shell-quoted already
     """
     cron = CronTab('root')
+    # cron turns unescaped % into newlines
+    command = ('/usr/sbin/akroma-mn-setup %s' % args).rstrip().replace('%', '\\%')
+    jobs = []
+    for job in cron.find_comment('Akroma MasterNode Auto-Update'):
+        m = re.search(r'--instance[ =](\d+)', job.command)
+        if (int(m.group(1)) if m else None) == instance:
+            jobs.append(job)
     if remove:
         print_cmd('Removing Akroma MasterNode auto-update...')
-        cron.remove_all(comment='Akroma MasterNode Auto-Update')
+        cron.remove(jobs)
         cron.write()
-    elif not sum(1 for _ in cron.find_comment('Akroma MasterNode Auto-Update')):
+    elif jobs:
+        if any(job.command != command for job in jobs):
+            print_cmd('Updating Akroma MasterNode auto-update...')
+            for job in jobs:
+                job.set_command(command)
+            cron.write()
+    else:
         res = input_bool('Auto-update Akroma MasterNode? [Y/n]', 'Y')
         if res == 'Y':
             print_cmd('Enabling Akroma MasterNode auto-update...')
-            job = cron.new(command='/usr/sbin/akroma-mn-setup', comment='Akroma MasterNode Auto-Update')
+            job = cron.new(command=command, comment='Akroma MasterNode Auto-Update')
             job.setall('%d %d * * *' % (random.randint(0, 59), random.randint(0, 23)))
             cron.write()
             print_cmd('Enabling and starting cron service...')
             if os_family == 'RedHat':
-                ret, _ = timed_run('/usr/bin/yum -d1 -y install cronie')
+                ret, _ = stream_run('/usr/bin/yum -d1 -y install cronie')
             else:
-                ret, _ = timed_run('/usr/bin/apt-get install cron -y')
+                ret, _ = stream_run('/usr/bin/apt-get install cron -y')
             if ret is None or int(ret) != 0:
                 raise Exception("ERROR: Failed to install cron")
             service = 'cron' if os_family != 'RedHat' else 'crond'
@@ -59,26 +99,93 @@ def check_perms(filename, permissions, uid=0, gid=0):
     except OSError:
         raise Exception("ERROR: Failed to set ownership/permissions on %s" % filename)
 
+def check_ports(ip, probes, timeout=5):
+    """
+    Concurrently probe network IP/port sockets sharing one overall timeout
+
+    Args:
+        ip      : (str) IPv4 address to probe
+        probes  : (list) (proto, port) tuples, proto being 'tcp' or 'udp'
+        timeout : (int) overall time budget for all probes (in sec)
+
+    Return a dict keyed by (proto, port) of (state, latency in ms).  TCP state
+    is 'open', 'closed' or 'filtered'.  UDP is connectionless, so a silent port
+    is reported 'open|filtered' and only an ICMP port unreachable is 'closed'.
+    """
+    results = {}
+    pending = {}
+    start = time.time()
+    for proto, port in probes:
+        if not isinstance(port, (int)) or not isvalidip(ip):
+            results[(proto, port)] = ('invalid', None)
+            continue
+        kind = socket.SOCK_STREAM if proto == 'tcp' else socket.SOCK_DGRAM
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_INET, kind)
+            sock.setblocking(0)
+            err = sock.connect_ex((ip, port))
+            if proto == 'udp' and err == 0:
+                # An empty datagram is enough to provoke ICMP port unreachable
+                try:
+                    sock.send('')
+                except socket.error as e:
+                    err = e.errno
+        except socket.error:
+            results[(proto, port)] = ('closed', int((time.time() - start) * 1000))
+            if sock:
+                sock.close()
+            continue
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            results[(proto, port)] = ('closed', int((time.time() - start) * 1000))
+            sock.close()
+            continue
+        pending[sock] = (proto, port)
+
+    try:
+        while pending:
+            remaining = timeout - (time.time() - start)
+            if remaining <= 0:
+                break
+            tcp = [s for s, (proto, _) in pending.items() if proto == 'tcp']
+            udp = [s for s, (proto, _) in pending.items() if proto == 'udp']
+            readable, writable, _ = select.select(udp, tcp, [], remaining)
+            latency = int((time.time() - start) * 1000)
+            for sock in writable:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                state = 'open' if err == 0 else 'closed'
+                results[pending.pop(sock)] = (state, latency)
+                sock.close()
+            for sock in readable:
+                try:
+                    sock.recv(1)
+                    state = 'open'
+                except socket.error:
+                    state = 'closed'
+                results[pending.pop(sock)] = (state, latency)
+                sock.close()
+    finally:
+        for sock, (proto, port) in pending.items():
+            state = 'filtered' if proto == 'tcp' else 'open|filtered'
+            results[(proto, port)] = (state, None)
+            sock.close()
+    return results
+
 def check_socket(ip, port, timeout=5):
     """
     Check if an network IP/port socket is open
     Return True if it's open, False otherwise.
     """
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.settimeout(timeout)
-    try:
-        if not isinstance(port, (int)):
-            raise socket.error
-        ret = sock.connect((ip, port))
-        return True
-    except socket.error:
-        return False
+    return check_ports(ip, [('tcp', port)], timeout)[('tcp', port)][0] == 'open'
 
 def execute(cmd, tmo=60, max_retries=1, wait_ms=0, \
             stdin_str=None, log=True, separate_stderr=True):
     """
     Run an external command with a timeout
 
+    Only the last OUTPUT_TAIL lines of output are logged or reported on
+    failure.  Use execute_stream for commands with large output.
+
     Args:
         cmd         : (str) command to execute
         tmo         : (int) maximum timeout to complete an individual execution
@@ -95,33 +202,134 @@ def execute(cmd, tmo=60, max_retries=1, wait_ms=0, \
     def _execute(cmd, tmo, stdin_str, log, separate_stderr):
         if log:
             logging.info(">> running '%s' (timeout=%d)" % (cmd, tmo))
-        stdin = PIPE if stdin_str is not None else None
-        if separate_stderr:
-            p = Popen(shlex.split(cmd), stderr=PIPE, stdout=PIPE, stdin=stdin)
-            out, err = p.communicate(timeout=tmo, input=stdin_str)
-        else:
-            p = Popen(shlex.split(cmd), stderr=STDOUT, stdout=PIPE, stdin=stdin)
-            out = p.communicate(timeout=tmo, input=stdin_str)[0].rstrip()
-            err = ''
+        out, err = [], []
+        returncode = 0
+        try:
+            for name, line in execute_lines(cmd, tmo, stdin_str, separate_stderr, max_line=None):
+                (out if name == 'stdout' else err).append(line)
+        except CalledProcessError as e:
+            returncode = e.returncode
+        out, err = '\n'.join(out), '\n'.join(err)
         if log:
             logging.info(">>> '%s' returned=%s\nstdout=%s\nstderr=%s" % \
-                         (cmd, str(p.returncode), str(out), str(err)))
-        if int(p.returncode) != 0:
+                         (cmd, str(returncode), _tail(out), _tail(err)))
+        if int(returncode) != 0:
             raise Exception("%s: returned=%s\nstdout=%s\nstderr=%s" % \
-                            (cmd, str(p.returncode), str(out), str(err)))
+                            (cmd, str(returncode), _tail(out), _tail(err)))
         if separate_stderr:
-            return p.returncode, out, err
+            return returncode, out, err
 
-        return p.returncode, out
+        return returncode, out
     return _execute(cmd, tmo, stdin_str, log, separate_stderr)
 
+def execute_lines(cmd, tmo=60, stdin_str=None, separate_stderr=False, max_line=65536):
+    """
+    Run an external command with a timeout, yielding its output as it comes
+
+    Yield (stream, line) tuples, stream being 'stdout' or 'stderr', lines
+    longer than max_line being split (None to never split them).  Closing the generator terminates the
+    command.  Raise TimeoutExpired or CalledProcessError (non-zero return).
+    """
+    stdin = PIPE if stdin_str is not None else None
+    stderr = PIPE if separate_stderr else STDOUT
+    p = Popen(shlex.split(cmd), stderr=stderr, stdout=PIPE, stdin=stdin)
+    if stdin_str is not None:
+        # Feed stdin from a thread, the command may not read it before writing
+        def _write():
+            try:
+                p.stdin.write(stdin_str)
+            except IOError:
+                pass
+            finally:
+                p.stdin.close()
+        threading.Thread(target=_write).start()
+
+    pipes = {p.stdout.fileno(): ['stdout', '']}
+    if separate_stderr:
+        pipes[p.stderr.fileno()] = ['stderr', '']
+    deadline = time.time() + tmo
+    try:
+        while pipes:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutExpired(cmd, tmo)
+            ready, _, _ = select.select(list(pipes), [], [], remaining)
+            for fd in ready:
+                name, buf = pipes[fd]
+                data = os.read(fd, 65536)
+                if not data:
+                    if buf:
+                        yield name, buf
+                    del pipes[fd]
+                    continue
+                lines = (buf + data).split('\n')
+                buf = lines.pop()
+                while max_line and len(buf) > max_line:
+                    lines.append(buf[:max_line])
+                    buf = buf[max_line:]
+                pipes[fd][1] = buf
+                for line in lines:
+                    yield name, line
+        p.wait(timeout=max(deadline - time.time(), 0))
+    finally:
+        if p.returncode is None:
+            p.kill()
+            p.wait()
+        for f in (p.stdout, p.stderr):
+            if f:
+                f.close()
+    if p.returncode != 0:
+        raise CalledProcessError(p.returncode, cmd)
+
+def execute_stream(cmd, callback=None, tmo=60, until=None, stdin_str=None, \
+                   log=True, separate_stderr=False, tail=OUTPUT_TAIL):
+    """
+    Run an external command with a timeout, handing its output line by line
+    to callback, in constant memory
+
+    Args:
+        cmd         : (str) command to execute
+        callback    : (func) called with (stream, line) for every line of output
+        tmo         : (int) maximum timeout to complete the command (in sec)
+        until       : (str) regex terminating the command as soon as a line
+                            matches it
+        stdin_str   : (str) data passed to stdin of the executed program
+        log         : (bool) enable/disable logging
+        separate_stderr : (bool) enable/disable separation of stdout and stderr
+        tail        : (int) lines of output kept for logging/error reports
+
+    Return the match object of until, None if it is not set or never matched
+    """
+    if log:
+        logging.info(">> running '%s' (timeout=%d)" % (cmd, tmo))
+    last = collections.deque(maxlen=tail)
+    regex = re.compile(until) if until else None
+    lines = execute_lines(cmd, tmo, stdin_str, separate_stderr)
+    try:
+        for name, line in lines:
+            last.append(line)
+            if callback:
+                callback(name, line)
+            m = regex.search(line) if regex else None
+            if m:
+                if log:
+                    logging.info(">>> '%s' matched '%s'" % (cmd, until))
+                return m
+    except (CalledProcessError, TimeoutExpired) as e:
+        raise Exception("%s: %s\noutput=%s" % (cmd, str(e), '\n'.join(last)))
+    finally:
+        lines.close()
+    if log:
+        logging.info(">>> '%s' returned=0\noutput=%s" % (cmd, '\n'.join(last)))
+    return None
+
 def get_enodeid(args):
     """
     Get enodeid of running geth process
     """
     try:
-        user_home = os.path.expanduser('~%s' % args.user)
-        ret, out, _ = timed_run('/usr/sbin/geth-akroma attach --datadir %s/.akroma/ --exec "admin.nodeInfo.id"' % user_home, separate_stderr=True)
+        ret, out, _ = timed_run('/usr/sbin/geth-akroma attach --datadir %s --exec "admin.nodeInfo.id"' % \
+                                datadir(args), separate_stderr=True)
         if ret is None or int(ret) != 0:
             raise ValueError
     except ValueError:
@@ -178,6 +386,39 @@ def isvalidusername(user):
         return True
     return False
 
+def isvalidcpus(cpus):
+    """
+    Verify valid CPUAffinity list (ie, '0 1', '0-3' or '0,2'), or auto
+    """
+    if cpus == 'auto':
+        return True
+    if not re.match(r'^\d+(-\d+)?([ ,]+\d+(-\d+)?)*$', cpus):
+        return False
+    ncpu = multiprocessing.cpu_count()
+    for item in re.split(r'[ ,]+', cpus):
+        first, _, last = item.partition('-')
+        if int(last or first) >= ncpu or int(first) > int(last or first):
+            return False
+    return True
+
+def parse_cpus(cpus):
+    """
+    Expand a valid CPUAffinity list (ie, '0 1', '0-3' or '0,2') to CPU numbers
+    """
+    ret = []
+    for item in re.split(r'[ ,]+', cpus.strip()):
+        first, _, last = item.partition('-')
+        ret.extend(range(int(first), int(last or first) + 1))
+    return ret
+
+def isvalidip(ip):
+    """
+    Verify valid dotted-quad IPv4 address
+    """
+    if re.match(r'^\d{1,3}(\.\d{1,3}){3}$', ip) and all(int(i) < 256 for i in ip.split('.')):
+        return True
+    return False
+
 def isvalidrpcinfo(data):
     """
     Verify valid rpcuser or rpcpassword
@@ -186,15 +427,130 @@ def isvalidrpcinfo(data):
         return True
     return False
 
-def my_ip():
+def concurrent(calls):
+    """
+    Run (func, args) calls in parallel threads
+    Return their results in order, re-raising the first exception, if any
+    """
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+    def _run(i, func, args):
+        try:
+            results[i] = func(*args)
+        except Exception: # pylint: disable=broad-except
+            errors[i] = sys.exc_info()
+    threads = [threading.Thread(target=_run, args=(i, func, args)) for i, (func, args) in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error:
+            raise error[0], error[1], error[2]
+    return results
+
+def datadir(args):
     """
-    Get public ip address of server
-    TODO: Refactor into using requests/urllib3 AF_INET (not AF_INET6)
+    Get geth data directory of akromanode
     """
-    ret, out = timed_run('/usr/bin/curl --silent -4 icanhazip.com')
-    if ret is None or int(ret) != 0:
-        return 'ERROR: Failed to obtain node ip'
-    return out
+    return args.datadir or '%s/.akroma' % user_home(args.user or 'root')
+
+def default_route():
+    """
+    Get the (interface, gateway) of the IPv4 default route, None if unknown
+    """
+    try:
+        with open('/proc/net/route') as fd:
+            for line in fd.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 2 and fields[1] == '00000000':
+                    return fields[0], fields[2]
+    except IOError:
+        pass
+    return None
+
+def my_ip(endpoints=None, timeout=5, ttl=3600, cache_file=IP_CACHE_FILE):
+    """
+    Get public ip address of server
+
+    All endpoints are queried concurrently and the first valid IPv4 answer
+    wins.  The result is cached, on disk, for ttl seconds and discarded early
+    should the default route (interface/gateway) change.
+
+    Args:
+        endpoints  : (list) URLs returning the caller's IPv4 address as text
+                            (Default: IP_ENDPOINTS)
+        timeout    : (int) maximum time to wait for any endpoint (in sec)
+        ttl        : (int) cached address lifetime, 0 disables caching (in sec)
+        cache_file : (str) cache location, None keeps the cache in memory only
+    """
+    route = default_route()
+    route = list(route) if route else None
+    cache = _IP_CACHE
+    if ttl and not cache and cache_file:
+        try:
+            with open(cache_file) as fd:
+                cache.update(json.load(fd))
+        except (IOError, ValueError):
+            pass
+    if ttl and cache.get('route') == route and \
+       0 <= time.time() - cache.get('time', 0) < ttl and isvalidip(cache.get('ip', '')):
+        return str(cache['ip'])
+
+    answers = Queue.Queue()
+    def _query(url):
+        try:
+            ret = requests.get(url, timeout=timeout, headers={'User-Agent': 'curl'})
+            ip = ret.text.strip() if ret.status_code == 200 else None
+        except requests.exceptions.RequestException:
+            ip = None
+        answers.put(ip if ip and isvalidip(ip) else None)
+
+    endpoints = IP_ENDPOINTS if endpoints is None else endpoints
+    for url in endpoints:
+        thread = threading.Thread(target=_query, args=(url, ))
+        thread.daemon = True
+        thread.start()
+
+    deadline = time.time() + timeout
+    for _ in endpoints:
+        try:
+            ip = answers.get(timeout=max(deadline - time.time(), 0))
+        except Queue.Empty:
+            break
+        if ip:
+            cache.clear()
+            cache.update({'ip': ip, 'time': time.time(), 'route': route})
+            if ttl and cache_file:
+                try:
+                    directory = os.path.dirname(cache_file)
+                    if directory and not os.path.isdir(directory):
+                        os.makedirs(directory, 0o755)
+                    with open(cache_file, 'w') as fd:
+                        json.dump(cache, fd)
+                except (IOError, OSError):
+                    pass
+            return str(ip)
+    return 'ERROR: Failed to obtain node ip'
+
+def node_health(args, timeout=600, interval=10, checks=3):
+    """
+    Wait for akromanode to be healthy after a (re)start, that is its service
+    active and geth answering over IPC for checks consecutive polls
+    Return True if healthy before timeout, False otherwise
+    """
+    service = service_name(args.instance)
+    deadline = time.time() + timeout
+    passed = 0
+    while time.time() < deadline:
+        if service_status(service, 'is-active') and not get_enodeid(args).startswith('ERROR'):
+            passed += 1
+            if passed >= checks:
+                return True
+        else:
+            passed = 0
+        time.sleep(interval)
+    return False
 
 def os_detect():
     """
@@ -245,46 +601,104 @@ def os_detect():
         return os_name, _os_family_map[os_family], int(os_ver), os.uname()[4]
     return os_name, None, int(os_ver), os.uname()[4]
 
+def allocate_port(start, taken, udp=False):
+    """
+    Find the first port, from start, neither in taken nor bound on this host
+    """
+    port = start
+    while True:
+        if port not in taken:
+            kinds = (socket.SOCK_STREAM, socket.SOCK_DGRAM) if udp else (socket.SOCK_STREAM, )
+            try:
+                for kind in kinds:
+                    sock = socket.socket(socket.AF_INET, kind)
+                    try:
+                        sock.bind(('', port))
+                    finally:
+                        sock.close()
+                return port
+            except socket.error:
+                pass
+        port += 1
+
+def cpu_affinity(instance):
+    """
+    Pick CPUs for akromanode instance (None being the single akromanode)
+    Return its CPUAffinity list
+
+    Every unit gets an equal share of the host CPUs, taken from those no
+    other unit is pinned to (the least used ones once all are taken).  Other
+    units are never re-pinned, so their CPUs stay theirs.
+    """
+    ncpu = multiprocessing.cpu_count()
+    units = set(instances() + [instance])
+    per = max(1, ncpu // len(units))
+    load = dict((cpu, 0) for cpu in range(ncpu))
+    current = []
+    for i in units:
+        _, config = service_unit.load(service_file_path(i))
+        if config is None or not config.cpus or not isvalidcpus(config.cpus):
+            continue
+        if i == instance:
+            current = parse_cpus(config.cpus)
+            continue
+        for cpu in parse_cpus(config.cpus):
+            if cpu in load:
+                load[cpu] += 1
+    # Least used first, keeping the CPUs instance already has on a tie
+    cpus = sorted(load, key=lambda cpu: (load[cpu], cpu not in current, cpu))[:per]
+    return ' '.join(str(cpu) for cpu in sorted(cpus))
+
+def instances():
+    """
+    List installed akromanode instances, None being the single akromanode
+    """
+    ret = [None] if os.path.isfile(service_file_path()) else []
+    for f in glob.glob('%s/akromanode@*.service' % SERVICE_DIR):
+        m = re.search(r'akromanode@(\d+)\.service$', f)
+        if m:
+            ret.append(int(m.group(1)))
+    return sorted(ret)
+
 def parse_service_file(args):
     """
-    Parse akromanode.service, if it exists, and set/override defaults
+    Parse akromanode.service (akromanode@N.service for --instance N), if it
+    exists, and set/override defaults
     """
     # Set default args if undefined
-    for i in ('rpcpassword', 'rpcport', 'port', 'rpcuser', 'user'):
+    for i in ('rpcpassword', 'rpcport', 'port', 'rpcuser', 'user', 'instance', 'datadir', 'cpus', 'cpu_shares'):
         if i not in args:
             setattr(args, i, None)
     for i in ('no_rpcuser', ):
         if i not in args:
             setattr(args, i, False)
 
-    service_file = '/etc/systemd/system/akromanode.service'
-    content = None
-    try:
-        with open(service_file) as fd:
-            content = fd.read()
-            m = re.search(r'User=(.+)', content)
-            if m:
-                if args.user is None:
-                    args.user = m.group(1)
-            m = re.search(r'--port\s+(\d+)', content)
-            if m:
-                if args.port is None:
-                    args.port = int(m.group(1))
-            m = re.search(r'--rpcport\s+(\d+)', content)
-            if m:
-                if args.rpcport is None:
-                    args.rpcport = int(m.group(1))
-            m = re.search(r'--rpcuser\s+(\w+)', content)
-            if m:
-                if args.rpcuser is None:
-                    args.rpcuser = m.group(1)
-            m = re.search(r'--rpcpassword\s+(\w+)', content)
-            if m:
-                if args.rpcpassword is None:
-                    args.rpcpassword = m.group(1)
-    except IOError:
-        pass
+    service_file = service_file_path(args.instance)
+    content, config = service_unit.load(service_file)
+    if config:
+        for i in ('user', 'port', 'rpcport', 'rpcuser', 'rpcpassword', 'datadir', 'cpus', 'cpu_shares'):
+            if getattr(args, i) is None:
+                setattr(args, i, getattr(config, i))
+        if args.port is None:
+            # Units written before instance ports were always rendered omit the default
+            args.port = 30303
 
+    if args.instance:
+        # Isolate instances: own user, datadir, CPUs, and ports unused by any other instance
+        if args.user is None and content is None:
+            args.user = 'akroma%d' % args.instance
+        if args.datadir is None:
+            args.datadir = '%s/.akroma-%d' % (user_home(args.user or 'root'), args.instance)
+        if args.cpus is None and content is None:
+            args.cpus = 'auto'
+        taken = taken_ports(args.instance)
+        if args.port is None:
+            args.port = allocate_port(30303 + args.instance, taken, udp=True)
+        taken.add(args.port)
+        if args.rpcport is None:
+            args.rpcport = allocate_port(8545 + args.instance, taken)
+    if args.cpus == 'auto':
+        args.cpus = cpu_affinity(args.instance)
     if args.port is None:
         args.port = 30303
     if args.rpcport is None:
@@ -304,21 +718,42 @@ def print_cmd(cmd):
     print cmd
     print "=========================="
 
-def resource_path(relative_path):
-    """ Get absolute path to resource, works for dev and for PyInstaller """
-    try:
-        # PyInstaller creates a temp folder and stores path in _MEIPASS
-        base_path = sys._MEIPASS
-    except AttributeError:
-        base_path = os.path.abspath(".")
+def service_file_path(instance=None):
+    """
+    Get akromanode systemd unit file path
+    """
+    return '%s/%s.service' % (SERVICE_DIR, service_name(instance))
+
+def service_name(instance=None):
+    """
+    Get akromanode systemd unit name, akromanode@N for instance N
+    """
+    return 'akromanode@%d' % instance if instance else 'akromanode'
 
-    return os.path.join(base_path, relative_path)
+def service_ports(instance=None):
+    """
+    Get the (port, rpcport) configured in akromanode unit file
+    """
+    _, config = service_unit.load(service_file_path(instance))
+    if config is None:
+        return ()
+    return config.port or 30303, config.rpcport or 8545
+
+def taken_ports(instance=None):
+    """
+    Get the ports configured in every akromanode unit file but instance's
+    """
+    taken = set()
+    for i in instances():
+        if i != instance:
+            taken.update(service_ports(i))
+    return taken
 
 def service_status(service, status):
     """
     Check/change provided service status
     """
-    ret, _ = timed_run('/bin/systemctl %s %s' % (status, service))
+    ret, _ = stream_run('/bin/systemctl %s %s' % (status, service))
     if ret is None or int(ret) != 0:
         return False
     return True
@@ -327,14 +762,38 @@ def script_version(cmd):
     """
     Get local script version
     """
-    ret, out = timed_run(cmd)
+    ret, m = stream_run(cmd, until=r'Version:\s*([\.0-9]+)')
     if ret is None or int(ret) != 0:
         return 'Unknown'
-    m = re.search(r'Version:\s*([\.0-9]+)', out)
     if m:
         return str(m.group(1))
     return 'Unknown'
 
+def user_home(user):
+    """
+    Get home directory of user, even before the user is created
+    """
+    try:
+        return pwd.getpwnam(user).pw_dir
+    except KeyError:
+        return '/root' if user == 'root' else '/home/%s' % user
+
+def stream_run(cmd, timeout=120, callback=None, until=None, log=True):
+    """
+    Run an external command, streaming its output (handle exceptions internally)
+    Return (0, until match) on success, (None, None) otherwise
+    """
+    try:
+        return 0, execute_stream(cmd, callback=callback, tmo=timeout, until=until, log=log)
+    except Exception:
+        return None, None
+
+def _tail(output, lines=OUTPUT_TAIL):
+    """
+    Get the last lines of output
+    """
+    return '\n'.join(output.rsplit('\n', lines)[-lines:])
+
 def timed_run(cmd, timeout=120, log=True, stdin_str=None, separate_stderr=False):
     """
     Run an external command with a timeout (handle exceptions internally)